@@ -1,4 +1,12 @@
+import codecs
+import gc
+import io
+import os
+import selectors
 import subprocess
+import sys
+from collections import deque
+from itertools import permutations
 from subprocess import Popen, PIPE
 from pychess.Utils import Move
 from pychess.Utils.Board import Board
@@ -8,30 +16,45 @@ from pychess.Utils.const import WHITE, BLACK
 from pychess.Utils.logic import getStatus
 import time
 
-ENCODING="utf-8"
-
-def len_gt_zero(generator):
-    for item in generator:
-        return True
-
-    return False
-
-def get_walltime():
-    # Milliseconds
-    return time.monotonic_ns() // 1000_000
+PIPE_BUFFER_SIZE=65536
+ENGINE_NICENESS=-5
+# The info fields we record, and the fields after which the rest of the line is free text or moves
+INFO_KEYWORDS=frozenset(("depth", "score", "time", "tbhits", "pv", "string"))
 
 class Player:
-    def __init__(self, engine=None):
+    def __init__(self, engine=None, cpu: int | None = None):
         exec_name = engine if engine else "stockfish"
-        process = Popen([exec_name], stdin=PIPE, stdout=PIPE)
+
+        def pin_and_prioritise():
+            # Runs in the child before exec, so every thread the engine starts inherits both settings
+            if cpu != None:
+                os.sched_setaffinity(0, {cpu})
+            if os.geteuid() == 0:
+                # Only root may raise priority
+                os.setpriority(os.PRIO_PROCESS, 0, ENGINE_NICENESS)
+
+        process = Popen([exec_name], stdin=PIPE, stdout=PIPE, bufsize=PIPE_BUFFER_SIZE, preexec_fn=pin_and_prioritise)
         self._process = process
-        self._pipe_send = process.stdin
+        self._pipe_send = io.TextIOWrapper(process.stdin, encoding="utf-8")
+        # Read bytes and split lines ourselves, so that no complete line can hide in a text
+        # wrapper's buffer while the selector reports the pipe as idle
         self._pipe_recv = process.stdout
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._partial_line = ""
+        self._lines = deque()
         self._options = None
         self._midgameoptions = None
+        self._sent_options = dict()
         self._maxdepth = None
         self._movetime = None
         self._time_management = True
+        self._searchinfo = dict()
+        self._ponder = False
+        self._pondering = False
+        self._stale_bestmoves = 0
+        self._ponder_position = None
+        self._position = None
+        self._clock = None, None
 
         line = self._readline()
 
@@ -55,26 +78,85 @@ class Player:
         self._maxdepth = maxdepth
         self._movetime = movetime
 
-    def new_game(self):
-        self._sendline("ucinewgame")
+    def set_ponder(self, ponder: bool):
+        # Think on the expected reply during the opponent's turn
+        self._ponder = ponder
+        self.set_option("Ponder", "true" if ponder else "false")
 
+    def new_game(self):
+        self._stop_pondering()
+        lines = ["ucinewgame"]
         if self._options != None:
-            for option, value in self._options.items():
-                self._send_option(option, value)
+            lines += self._option_lines(self._options)
+        lines.append("isready")
 
-        self._sendline("isready")
-        isready = self._handleincoming()
-        assert isready[0] == "readyok"
+        self._send_many(lines)
+        self._expectline("readyok")
 
     def enter_midgame(self):
         if self._midgameoptions != None:
-            for name, value in self._midgameoptions.items():
-                self._send_option(name, value)
+            # Options may not be changed while the engine is searching
+            self._stop_pondering()
+            self._send_many(self._option_lines(self._midgameoptions))
 
     def play_position(self, position, wtime=None, btime=None):
-        self._searchinfo = dict()
+        self.start_search(position, wtime, btime)
+        bestmove, searchinfo, _ = self.wait_search()
+        return bestmove, searchinfo
+
+    def start_search(self, position, wtime=None, btime=None):
+        self._position = position
+        self._clock = wtime, btime
+        if self._pondering:
+            if position == self._ponder_position:
+                # The opponent played the expected move, so the ponder search carries on as the real one
+                self._pondering = False
+                self._sendline("ponderhit")
+                self._pipe_send.flush()
+                return
+
+            self._stop_pondering()
+
+        self._searchinfo.clear()
         self._sendline("position " + position)
-        go_string = "go"
+        self._sendline(self._go_string(wtime, btime))
+        self._pipe_send.flush()
+
+    def wait_search(self):
+        result = self._handleincoming()
+        return self._finish_search(result, time.monotonic_ns())
+
+    def poll_search(self):
+        # Call when the pipe is readable. Returns the search result once bestmove has arrived, else None
+        self._receive()
+        stoptime = time.monotonic_ns()
+        lines = self._lines
+        handleline = self._handleline
+        while lines:
+            linewords = handleline(lines.popleft())
+            if linewords != None:
+                return self._finish_search(linewords, stoptime)
+
+        return None
+
+    def fileno(self):
+        return self._pipe_recv.fileno()
+
+    def _finish_search(self, result, stoptime):
+        if result[0] != "bestmove":
+            raise RuntimeError(f"Expected bestmove, got {result}")
+
+        movewords = result[1].split(" ")
+        bestmove = movewords[0]
+        # Copy, since the dict is reused by the next search
+        searchinfo = dict(self._searchinfo)
+        if self._ponder and len(movewords) >= 3 and movewords[1] == "ponder":
+            self._start_pondering(bestmove, movewords[2])
+
+        return bestmove, searchinfo, stoptime
+
+    def _go_string(self, wtime, btime, ponder=False):
+        go_string = "go ponder" if ponder else "go"
         if self._maxdepth:
             go_string += f" depth {self._maxdepth}"
         if self._movetime:
@@ -84,69 +166,134 @@ class Player:
                 go_string += f" wtime {wtime}"
             if btime != None:
                 go_string += f" btime {btime}"
-        self._sendline(go_string)
-        result = self._handleincoming()
-        assert result[0] == "bestmove"
-
-        bestmove = result[1].split(" ", maxsplit=1)[0]
+        return go_string
+
+    def _start_pondering(self, bestmove, pondermove):
+        position = self._position if " moves" in self._position else self._position + " moves"
+        self._ponder_position = f"{position} {bestmove} {pondermove}"
+        self._searchinfo.clear()
+        self._sendline("position " + self._ponder_position)
+        self._sendline(self._go_string(*self._clock, ponder=True))
+        self._pipe_send.flush()
+        self._pondering = True
 
-        return bestmove, self._searchinfo
+    def _stop_pondering(self):
+        if self._pondering:
+            # The engine answers stop with a bestmove for the pondered position. Rather than wait for
+            # it here, _handleline drops it when it arrives, ahead of the replies to whatever we send next
+            self._pondering = False
+            self._stale_bestmoves += 1
+            self._sendline("stop")
+            self._pipe_send.flush()
 
     def close(self):
         self._sendline("quit")
         self._pipe_send.flush()
         self._process.wait()
 
-    def _send_option(self, name, value):
-        print(f"DEBUG: _send_option {name} = {value}    {self}")
-        self._sendline("setoption name " + name + " value " + str(value))
+    def _option_lines(self, options):
+        # Options persist across ucinewgame, so only send the ones that changed
+        lines = []
+        for name, value in options.items():
+            if name in self._sent_options and self._sent_options[name] == value:
+                continue
+
+            self._sent_options[name] = value
+            print(f"DEBUG: setoption {name} = {value}    {self}")
+            lines.append("setoption name " + name + " value " + str(value))
+
+        return lines
 
     def _readline(self):
-        while True:
-            string = str(self._pipe_recv.readline(), encoding=ENCODING)
-            string = string.strip()
-            if len(string) > 0:
-                return string
+        while not self._lines:
+            self._receive()
+
+        return self._lines.popleft()
+
+    def _receive(self):
+        # read1 makes at most one read() on the pipe, so it does not block once select says it is readable
+        chunk = self._pipe_recv.read1(PIPE_BUFFER_SIZE)
+        if len(chunk) == 0:
+            raise EOFError(f"Engine {self} closed its output")
 
+        lines = (self._partial_line + self._decoder.decode(chunk)).split("\n")
+        self._partial_line = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if len(line) > 0:
+                self._lines.append(line)
 
     def _sendline(self, line):
-        self._pipe_send.write(bytes(line + "\n", encoding=ENCODING))
+        self._pipe_send.write(line + "\n")
+
+    def _send_many(self, lines):
+        if len(lines) > 0:
+            self._pipe_send.write("\n".join(lines) + "\n")
 
     def _expectline(self, expected):
         line = self._handleincoming()
-        assert line[0] == expected, f"Expected {expected}, got {line}"
+        if line[0] != expected:
+            raise RuntimeError(f"Expected {expected}, got {line}")
 
     def _handleincoming(self):
         self._pipe_send.flush()
+        readline = self._readline
+        handleline = self._handleline
         while True:
-            line = self._readline()
-            linewords = line.split(" ", maxsplit=1)
-            if linewords[0] == "id":
-                pass # Ignore
-            elif linewords[0] == "info":
-                infowords = linewords[1].split(" ")
-                if "depth" in infowords:
-                    depth = int(infowords[infowords.index("depth") + 1])
-                    if "depth" not in self._searchinfo or depth > self._searchinfo["depth"]:
-                        self._searchinfo["depth"] = depth
-                if "score" in infowords:
-                    location = infowords.index("score")
-                    score = infowords[location + 1] + " " + infowords[location + 2]
-                    self._searchinfo["score"] = score
-                if "time" in infowords:
-                    time_used = int(infowords[infowords.index("time") + 1])
-                    if "time" not in self._searchinfo or time_used > self._searchinfo["time"]:
-                        self._searchinfo["time"] = time_used
-                if "tbhits" in infowords:
-                    tbhits = int(infowords[infowords.index("tbhits") + 1])
-                    if tbhits > 0 and ("tbhits" not in self._searchinfo or tbhits > self._searchinfo["tbhits"]):
-                        self._searchinfo["tbhits"] = tbhits
-
-            elif linewords[0] == "option":
-                pass # Ignore
-            else:
+            linewords = handleline(readline())
+            if linewords != None:
                 return linewords
 
+    def _handleline(self, line):
+        # Returns the split line if it is a reply to a command, None if it was only informative
+        linewords = line.split(" ", maxsplit=1)
+        if linewords[0] == "id":
+            pass # Ignore
+        elif linewords[0] == "info":
+            if " pv" not in linewords[1] or self._stale_bestmoves > 0:
+                # Only the principal variation lines summarise a finished iteration;
+                # currmove, hashfull, nps and string lines carry nothing we record.
+                # Lines from a stopped ponder search don't belong to the current one
+                return None
+            searchinfo = self._searchinfo
+            infowords = linewords[1].split(" ")
+            wordcount = len(infowords)
+            i = 0
+            while i < wordcount:
+                word = infowords[i]
+                if word not in INFO_KEYWORDS:
+                    i += 1
+                elif word == "depth":
+                    depth = int(infowords[i + 1])
+                    if "depth" not in searchinfo or depth > searchinfo["depth"]:
+                        searchinfo["depth"] = depth
+                    i += 2
+                elif word == "score":
+                    searchinfo["score"] = infowords[i + 1] + " " + infowords[i + 2]
+                    i += 3
+                elif word == "time":
+                    time_used = int(infowords[i + 1])
+                    if "time" not in searchinfo or time_used > searchinfo["time"]:
+                        searchinfo["time"] = time_used
+                    i += 2
+                elif word == "tbhits":
+                    tbhits = int(infowords[i + 1])
+                    if tbhits > 0 and ("tbhits" not in searchinfo or tbhits > searchinfo["tbhits"]):
+                        searchinfo["tbhits"] = tbhits
+                    i += 2
+                else:
+                    # pv or string: the rest of the line is moves or free text
+                    break
+
+        elif linewords[0] == "option":
+            pass # Ignore
+        elif linewords[0] == "bestmove" and self._stale_bestmoves > 0:
+            self._stale_bestmoves -= 1
+        else:
+            return linewords
+
+        return None
+
 def decode_match_end(state: int, explanation: int) -> str:
     if state == DRAW:
         if explanation == DRAW_STALEMATE:
@@ -180,114 +327,135 @@ def decode_match_end(state: int, explanation: int) -> str:
 class Match:
     _players: tuple[Player, Player]
     _board: Board
-    _time_left: list[int]
+    _time_left: list[int] # Nanoseconds
     _moves: list[Move.Move]
     _search_infos: list
-    _position_string: str
+    _position_moves: list[str]
     _status: tuple[int, int]
+    _starttime: int
 
-    def __init__(self, wplayer: Player, bplayer: Player, time: int=300_000, verbose: bool = False) -> None:
-        self._time_left = [time, time]
+    def __init__(self, wplayer: Player, bplayer: Player, time: int=300_000, verbose: bool = False, output=None) -> None:
+        self._time_left = [time * 1_000_000, time * 1_000_000]
         wplayer.new_game()
         bplayer.new_game()
         self._players = wplayer, bplayer
         self._board = Board(setup=True)
         self._moves = []
         self._search_infos = []
-        self._position_string = "startpos moves"
+        self._position_moves = []
         self._status = 0, 0
+        self._starttime = 0
         self._verbose = verbose
+        self._output = output if output != None else sys.stdout
 
     def play_ply(self):
-        if self._board.ply == 18:
+        player_up = self.start_ply()
+        self.finish_ply(*player_up.wait_search())
+
+    def start_ply(self) -> Player:
+        # Sends the position to the player whose turn it is, without waiting for its reply
+        board = self._board
+        if board.ply == 18:
             self._players[WHITE].enter_midgame()
             self._players[BLACK].enter_midgame()
 
-        color_up = self._board.color
+        color_up = board.color
         player_up: Player = self._players[color_up]
-        position_up = self._position_string
+        if self._position_moves:
+            position_up = "startpos moves " + " ".join(self._position_moves)
+        else:
+            position_up = "startpos"
+
+        player_up.start_search(position_up, wtime=self._time_left[WHITE] // 1_000_000, btime=self._time_left[BLACK] // 1_000_000)
+        # Stamped after start_search, which may first have to wait for a ponder search to stop
+        self._starttime = time.monotonic_ns()
+        return player_up
 
-        starttime = get_walltime()
-        move_str, search_info = player_up.play_position(position_up, wtime=self._time_left[WHITE], btime=self._time_left[BLACK])
-        stoptime = get_walltime()
-        time_spent = stoptime - starttime
+    def finish_ply(self, move_str, search_info, stoptime):
+        # stoptime is when the bestmove was read, not when the driver got round to this match
+        time_spent = stoptime - self._starttime
+        board = self._board
+        ply = board.ply
+        color_up = board.color
+        time_left = self._time_left
 
-        move = Move.parseAN(self._board, move_str)
-        self._time_left[color_up] -= time_spent
+        move = Move.parseAN(board, move_str)
+        time_left[color_up] -= time_spent
 
-        self._position_string += (" " + move_str)
+        self._position_moves.append(move_str)
         self._moves.append(move)
         self._search_infos.append(search_info)
 
         if self._verbose:
-            move_nbr = 1 + self._board.ply // 2
-            san = Move.toSAN(self._board, move)
+            move_nbr = 1 + ply // 2
+            san = Move.toSAN(board, move)
             if color_up == WHITE:
-                print(f"{move_nbr:3}. {san:6}   ", end="")
+                parts = [f"{move_nbr:3}. {san:6}   "]
             else:
-                print(f"        {san:6}", end="")
-                print(70*" ", end="")
-            score = search_info["score"]
-            depth = search_info["depth"]
-            print(f"  time = {self._time_left[color_up] / 1000}", end="")
+                parts = [f"        {san:6}", 70*" "]
+            parts.append(f"  time = {time_left[color_up] // 1_000_000 / 1000}")
             for key, value in search_info.items():
-                print(f"  {key} = {value:5}", end="")
-            print("")
+                parts.append(f"  {key} = {value:5}")
+            parts.append("\n")
+            self._output.write("".join(parts))
 
         # Update board
-        self._board = self._board.move(move)
+        new_board = board.move(move)
+        self._board = new_board
 
         # Add extra time if one player is running out: match never runs out of time
-        if self._time_left[color_up] < 100:
-            time_to_add = 100 - self._time_left[color_up]
-            self._time_left[WHITE] += time_to_add
-            self._time_left[BLACK] += time_to_add
-
-        # If time is up for color_up, that means self._board.color (which has now been updated) has won
-        if self._time_left[color_up] <= 0:
-            self._status = (WHITEWON if self._board.color == WHITE else BLACKWON,
+        if time_left[color_up] < 100_000_000:
+            time_to_add = 100_000_000 - time_left[color_up]
+            time_left[WHITE] += time_to_add
+            time_left[BLACK] += time_to_add
+
+        # If time is up for color_up, that means the other color has won
+        if time_left[color_up] <= 0:
+            self._status = (WHITEWON if color_up == BLACK else BLACKWON,
                             WON_CALLFLAG)
         else:
-            self._status = getStatus(self._board)
+            self._status = getStatus(new_board)
 
+        if self._verbose and self.is_over():
+            self._output.flush()
 
-    def finish_game(self) -> tuple[int, int]:
-        while True:
-            status, _ = self._status
-            if status in [DRAW, WHITEWON, BLACKWON]:
-                break
+    def is_over(self) -> bool:
+        status, _ = self._status
+        return status in [DRAW, WHITEWON, BLACKWON]
 
+    def finish_game(self) -> tuple[int, int]:
+        while not self.is_over():
             self.play_ply()
 
         return self._status
 
-def create_engine_player(engine="target/release/engine") -> Player:
-    player = Player(engine)
-    player.set_go_string(time_management=False, movetime=5000)
+def create_engine_player(engine="target/release/engine", movetime: int = 5000, cpu: int | None = None) -> Player:
+    player = Player(engine, cpu)
+    player.set_go_string(time_management=False, movetime=movetime)
     return player
 
-def create_engine_player_maxdepth(engine: str="target/release/engine", maxdepth: int = 7) -> Player:
-    player = Player(engine)
+def create_engine_player_maxdepth(engine: str="target/release/engine", maxdepth: int = 7, cpu: int | None = None) -> Player:
+    player = Player(engine, cpu)
     player.set_go_string(time_management=False, maxdepth=maxdepth)
     return player
 
-def create_stockfish20() -> Player:
-    player = create_stockfish(19)
+def create_stockfish20(cpu: int | None = None) -> Player:
+    player = create_stockfish(19, cpu)
     player.set_option_for_midgame("Skill Level", 20)
     return player
 
-def create_stockfish(level: int = 19) -> Player:
-    player = Player()
+def create_stockfish(level: int = 19, cpu: int | None = None) -> Player:
+    player = Player(cpu=cpu)
     player.set_option("Skill Level", level)
     return player
 
-def create_stockfish20_with_tables_5() -> Player:
-    player = create_stockfish20()
+def create_stockfish20_with_tables_5(cpu: int | None = None) -> Player:
+    player = create_stockfish20(cpu)
     player.set_option("SyzygyPath", "/home/ccdl/Development/syzygy/download")
     return player
 
-def create_stockfish20_with_tables_6() -> Player:
-    player = create_stockfish20()
+def create_stockfish20_with_tables_6(cpu: int | None = None) -> Player:
+    player = create_stockfish20(cpu)
     player.set_option("SyzygyPath", "/home/ccdl/Development/syzygy/download6")
     return player
 
@@ -305,7 +473,7 @@ class Matchresult:
         self.moves = moves
 
 class Teamresult:
-    def __init__(self, name, matchresults: list[Matchresult]):
+    def __init__(self, name):
         self.name = name
         self.played = 0
         self.wins = 0
@@ -316,42 +484,32 @@ class Teamresult:
         self.movepoints = 0
         self.movepoints_as_black = 0
 
-        for m in matchresults:
-            if m.played:
-                if m.white == name:
-                    self.played += 1
-                    if m.result == WHITEWON:
-                        self.wins += 1
-                        self.points += 2
-                        self.movepoints -= m.moves
-                    elif m.result == DRAW:
-                        self.draws += 1
-                        self.points += 1
-                    elif m.result == BLACKWON:
-                        self.losses += 1
-                        self.movepoints += m.moves
-                elif m.black == name:
-                    self.played += 1
-                    if m.result == BLACKWON:
-                        self.wins += 1
-                        self.points += 2
-                        self.points_as_black += 2
-                        self.movepoints -= m.moves
-                        self.movepoints_as_black -= m.moves
-                    elif m.result == DRAW:
-                        self.draws += 1
-                        self.points += 1
-                        self.points_as_black += 1
-                    elif m.result == WHITEWON:
-                        self.losses += 1
-                        self.movepoints += m.moves
-                        self.movepoints_as_black += m.moves
-
+    def add_result(self, m: Matchresult, as_black: bool):
+        self.played += 1
+        if m.result == DRAW:
+            self.draws += 1
+            points, movepoints = 1, 0
+        elif m.result == (BLACKWON if as_black else WHITEWON):
+            self.wins += 1
+            points, movepoints = 2, -m.moves
+        else:
+            self.losses += 1
+            points, movepoints = 0, m.moves
 
+        self.points += points
+        self.movepoints += movepoints
+        if as_black:
+            self.points_as_black += points
+            self.movepoints_as_black += movepoints
 
 
 def print_table(teams, matchresults):
-    table = [Teamresult(team, matchresults) for team in teams]
+    results = { team: Teamresult(team) for team in teams }
+    for m in matchresults:
+        if m.played:
+            results[m.white].add_result(m, as_black=False)
+            results[m.black].add_result(m, as_black=True)
+    table = list(results.values())
 
     # Include sortkey and sort with criterion 1
     # 1. Rank by points earned in all matches
@@ -365,29 +523,90 @@ def print_table(teams, matchresults):
         print(f"{t.name:11}: {t.wins:2} {t.draws:2} {t.losses:2}  {t.points/2}")
 
 
-def main():
-    #players = { "20": create_stockfish20(), "T5": create_stockfish20_with_tables_5(), "T6": create_stockfish20_with_tables_6(), "19": create_stockfish19() }
-    # players = { "20": create_stockfish20(), "19": create_stockfish19() }
-    players = { "new": create_engine_player(), "maxdepth": create_engine_player_maxdepth() }
-    # players = { str(depth): create_engine_player_maxdepth(maxdepth=depth) for depth in range(1,8) }
-    # players = { "stockfish": create_engine_player(engine="stockfish"), "me": create_engine_player() }
-    # players["stockfish"].set_go_string(time_management=False, movetime=10)
-    # players["me"].set_go_string(time_management=False, maxdepth=8)
-    matches = [ Matchresult(w, b) for w in players for b in players if w != b ]
-
+def play_matches(players, matchentries: list[Matchresult], time: int, cpus: list[int], verbose: bool = False,
+                 ponder: bool = False):
+    # Drives the matches in batches from this one thread, and the selector wakes us up for whichever
+    # engine answers first. Without ponder, only the engine to move thinks, so both engines of a
+    # match share one cpu and a batch holds one match per cpu. With ponder, the engine not to move
+    # thinks as well, so each engine gets a cpu of its own and a batch holds one match per two cpus
+    # (both share, if there is only one cpu). ponder needs engines that accept setoption and
+    # pondering, such as Stockfish; our own engine answers setoption with "Unknown command", so
+    # new_game fails waiting for readyok.
+    # Engines are started, and finished games handed back, only between batches, so that this
+    # blocking work never runs while a clock is ticking. Yields a list of (matchentry, match) per
+    # batch. Verbose move lines are collected per match, so that concurrent games don't interleave.
+    selector = selectors.DefaultSelector()
+    queued = deque(matchentries)
+    cpus_per_match = 2 if ponder and len(cpus) > 1 else 1
+
+    while queued:
+        batch = []
+        for i in range(0, len(cpus) - cpus_per_match + 1, cpus_per_match):
+            if not queued:
+                break
+            matchentry = queued.popleft()
+            wcpu, bcpu = cpus[i], cpus[i + cpus_per_match - 1]
+            print(f"Matching {matchentry.white} against {matchentry.black} on cpus {wcpu} and {bcpu}")
+            wplayer = players[matchentry.white](cpu=wcpu)
+            bplayer = players[matchentry.black](cpu=bcpu)
+            if ponder:
+                wplayer.set_ponder(True)
+                bplayer.set_ponder(True)
+            match = Match(wplayer, bplayer, time=time, verbose=verbose, output=io.StringIO())
+            batch.append((matchentry, match))
+
+        for _, match in batch:
+            selector.register(match.start_ply(), selectors.EVENT_READ, match)
+
+        while selector.get_map():
+            for key, _ in selector.select():
+                match = key.data
+                result = key.fileobj.poll_search()
+                if result == None:
+                    continue
+
+                selector.unregister(key.fileobj)
+                match.finish_ply(*result)
+                if not match.is_over():
+                    selector.register(match.start_ply(), selectors.EVENT_READ, match)
+
+        for _, match in batch:
+            match._players[WHITE].close()
+            match._players[BLACK].close()
+        yield batch
+
+    selector.close()
 
-    for matchentry in matches:
-        print(f"Matching {matchentry.white} against {matchentry.black}")
-        wplayer = players[matchentry.white]
-        bplayer = players[matchentry.black]
-        match = Match(wplayer, bplayer, time=4*60*1000, verbose=True)
-        match.finish_game()
-        print(match._board)
-        print(decode_match_end(*match._status))
-
-        matchentry.set_result(match._status[0], match._board.ply)
-        print_table(list(players), matches)
-        print("")
+def main():
+    #players = { "20": create_stockfish20, "T5": create_stockfish20_with_tables_5, "T6": create_stockfish20_with_tables_6, "19": create_stockfish19 }
+    # players = { "20": create_stockfish20, "19": create_stockfish19 }
+    players = { "new": create_engine_player, "maxdepth": create_engine_player_maxdepth }
+    # players = { str(depth): lambda cpu=None, depth=depth: create_engine_player_maxdepth(maxdepth=depth, cpu=cpu) for depth in range(1,8) }
+    # players = { "stockfish": lambda cpu=None: create_engine_player(engine="stockfish", movetime=10, cpu=cpu),
+    #             "me": lambda cpu=None: create_engine_player_maxdepth(maxdepth=8, cpu=cpu) }
+    matches = [ Matchresult(w, b) for w, b in permutations(players, 2) ]
+
+    # Leave the first cpu to this process, unless it is the only one
+    cpus = sorted(os.sched_getaffinity(0))
+    engine_cpus = cpus[1:] if len(cpus) > 1 else cpus
+
+    # Board.move copies the board every ply; collect between batches, when no game is running
+    gc.disable()
+    try:
+        for batch in play_matches(players, matches, 4*60*1000, engine_cpus, verbose=True):
+            for matchentry, match in batch:
+                print(f"{matchentry.white} against {matchentry.black}:")
+                print(match._output.getvalue(), end="")
+                print(match._board)
+                print(decode_match_end(*match._status))
+
+                matchentry.set_result(match._status[0], match._board.ply)
+                print_table(list(players), matches)
+                print("")
+
+            gc.collect()
+    finally:
+        gc.enable()
 
     for matchentry in matches:
         result = matchentry.result